@@ -9,94 +9,117 @@ was last unplugged from the AC.
 import re
 import subprocess
 import sys
+import time
 from bisect import bisect_left
-from datetime import datetime
+from calendar import timegm
+from itertools import islice
 
-TIMESTAMP_REGEX = r"(?P<timestamp>\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})\s[+-]\d{4}"
+# log lines start with a fixed-width timestamp like "2021-03-01 12:34:56 +0100"
+TIMESTAMP_LENGTH = 25
+DISPLAY_MARKER = "Display is turned "
+CHARGE_MARKER = "Using "
+CHARGE_TYPES = ("AC", "Batt", "BATT")
 
 
 def process_lines(pmset_lines):
-    start_index = start_charge = start_timestamp = start_display_state = None
-    charge_regex = re.compile(
-        TIMESTAMP_REGEX
-        + r"\s+\w+\s+.*Using (?P<type>AC|Batt|BATT)\s*\(Charge:\s*(?P<charge>\d+)%*\)"
-    )
-    display_regex = re.compile(
-        TIMESTAMP_REGEX + r"\s+\w+\s+Display is turned (?P<state>\w+)"
-    )
-
-    seen_batt = False
-    end_index = len(pmset_lines)
-    for i, line in enumerate(reversed(pmset_lines)):
-        match = charge_regex.match(line)
-        if not match:
-            continue
-        charge_type = match["type"]
+    """
+    Calculate and print the usage statistics since the PC was last unplugged from AC.
 
-        # if we're currently on AC, we will report on usage statistics up until we plugged in
-        if not seen_batt and charge_type == "AC":
-            end_index = len(pmset_lines) - i - 1
+    ``pmset_lines`` is the list of log lines. Only the lines from ``find_last_unplug`` onwards are parsed, and only
+    the events since the last unplug event are kept in memory.
+    """
+    start_charge = start_timestamp = start_display_state = None
+    last_charge_type = last_display_state = None
+    plugged_in = False
 
-        # if we've seen some battery entries we the AC event indicates the transition from plugged to unplugged
-        if seen_batt and charge_type == "AC":
-            break
+    # timestamps (as epoch seconds) and charges of the events are kept in separate lists so lookups can bisect the
+    # timestamps directly
+    charge_times = []
+    charge_values = []
+    displays = []
+    # bind the functions and markers used for every line to locals to avoid global and attribute lookups in the loop
+    parse = parse_line
+    convert = convert_timestamp
+    display_marker = DISPLAY_MARKER
+    charge_marker = CHARGE_MARKER
+    append_charge_time = charge_times.append
+    append_charge_value = charge_values.append
+    append_display = displays.append
+    for line in islice(pmset_lines, find_last_unplug(pmset_lines), None):
+        # most lines are neither charge nor display events, don't even call the parser for them
+        if display_marker not in line and charge_marker not in line:
+            continue
+        event = parse(line)
+        if event is None:
+            continue
+        timestamp, display_state, charge_type, charge = event
+        if display_state is not None:
+            last_display_state = display_state
+        unplugged = False
+        if charge_type is not None:
+            if charge_type != "AC" and last_charge_type == "AC":
+                # the transition from AC to battery is the unplug event, start over from here
+                start_charge = charge
+                start_timestamp = convert(timestamp)
+                start_display_state = last_display_state
+                plugged_in = False
+                unplugged = True
+                # clear the lists in place so the bound append methods stay valid
+                charge_times.clear()
+                charge_values.clear()
+                displays.clear()
+            elif charge_type == "AC" and last_charge_type != "AC":
+                # if we're currently on AC, we will report on usage statistics up until we plugged in
+                plugged_in = True
+            last_charge_type = charge_type
+            if start_timestamp is not None:
+                append_charge_time(convert(timestamp))
+                append_charge_value(charge)
+        # a display event on the unplug line is the display state at the unplug event, not a switch after it
+        if display_state is not None and start_timestamp is not None and not plugged_in and not unplugged:
+            append_display((timestamp, display_state))
 
-        # remember the last battery record as it might be the battery event when unplugged
-        if charge_type != "AC":
-            start_index = len(pmset_lines) - i
-            start_charge = int(match["charge"])
-            start_timestamp = convert_timestamp(match["timestamp"])
-            seen_batt = True
-    else:
+    if start_timestamp is None:
         print("Could not determine when the PC was last unplugged from AC.")
         sys.exit(1)
 
-    for line in reversed(pmset_lines[:start_index]):
-        match = display_regex.match(line)
-        if match:
-            start_display_state = match.groupdict()["state"]
-            break
-    else:
+    if start_display_state is None:
         print("Could not determine the state of the display when AC was unplugged.")
         sys.exit(1)
 
-    charge_events = [
-        (convert_timestamp(match[0]), int(match[-1]))
-        for match in charge_regex.findall("\n".join(pmset_lines[start_index - 1:]))
-    ]
-
     current_display_state = start_display_state
     last_display_switch = start_timestamp
     total_time_with_display_on = 0
     total_time_with_display_off = 0
     total_consumption_with_display_on = 0
     total_consumption_with_display_off = 0
+    # display switches are visited in chronological order, so each lookup can resume from the previous position
+    charge_pos = 0
+    # the distance to the closest charge event is only reported once instead of for every lookup
+    max_charge_distance = 0
 
-    for line in pmset_lines[start_index:end_index]:
-        display_match = display_regex.match(line)
-        if display_match:
-            groupdict = display_match.groupdict()
-            new_display_state = groupdict["state"]
-            if new_display_state == current_display_state:
-                continue
-            new_timestamp = convert_timestamp(groupdict["timestamp"])
-            duration = (new_timestamp - last_display_switch).total_seconds()
+    for timestamp, new_display_state in displays:
+        if new_display_state != current_display_state:
+            new_timestamp = convert_timestamp(timestamp)
+            duration = new_timestamp - last_display_switch
             current_display_state = new_display_state
-            consumption = (
-                    get_closest_event(charge_events, last_display_switch)[1]
-                    - get_closest_event(charge_events, new_timestamp)[1]
+            last_charge, distance, charge_pos = get_closest_charge(
+                charge_times, charge_values, last_display_switch, charge_pos
+            )
+            if distance > max_charge_distance:
+                max_charge_distance = distance
+            new_charge, distance, charge_pos = get_closest_charge(
+                charge_times, charge_values, new_timestamp, charge_pos
             )
+            if distance > max_charge_distance:
+                max_charge_distance = distance
+            consumption = last_charge - new_charge
             if duration > 300:
                 # only emit messages for states lasting longer than a few minutes
                 print(
-                    "{} to {}: Used {:>3}% of battery during {:>3}h {:>2}min of {}".format(
-                        last_display_switch.strftime("%Y-%m-%d %H:%M:%S"),
-                        new_timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                        consumption,
-                        int(duration / 3600),
-                        int(duration % 3600 / 60),
-                        "sleep" if current_display_state == "on" else "usage",
-                    )
+                    f"{format_timestamp(last_display_switch)} to {format_timestamp(new_timestamp)}: "
+                    f"Used {consumption:>3}% of battery during {int(duration / 3600):>3}h "
+                    f"{int(duration % 3600 / 60):>2}min of {'sleep' if current_display_state == 'on' else 'usage'}"
                 )
             if current_display_state == "on":
                 total_consumption_with_display_off += consumption
@@ -107,56 +130,49 @@ def process_lines(pmset_lines):
             last_display_switch = new_timestamp
 
     # if we're currently on battery , we need to measure time from last event
-    if end_index == len(pmset_lines):
+    if not plugged_in:
         # we assume that this script is only run manually, so the screen must be on now
-        duration = (datetime.now() - last_display_switch).total_seconds()
-        consumption = (
-                get_closest_event(charge_events, last_display_switch)[1] - get_current_charge()
-        )
+        # the log timestamps are in local time, so the current time has to be converted the same way
+        now = timegm(time.localtime())
+        duration = now - last_display_switch
+        last_charge, distance, _ = get_closest_charge(charge_times, charge_values, last_display_switch, charge_pos)
+        if distance > max_charge_distance:
+            max_charge_distance = distance
+        consumption = last_charge - get_current_charge()
         total_consumption_with_display_on += consumption
         total_time_with_display_on += duration
         print(
-            "{} to {}: Used {:>3}% of battery during {:>3}h {:>2}min of usage".format(
-                last_display_switch.strftime("%Y-%m-%d %H:%M:%S"),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                consumption,
-                int(duration / 3600),
-                int(duration % 3600 / 60),
-            )
+            f"{format_timestamp(last_display_switch)} to {format_timestamp(now)}: "
+            f"Used {consumption:>3}% of battery during {int(duration / 3600):>3}h "
+            f"{int(duration % 3600 / 60):>2}min of usage"
         )
 
-    # output summary
-    print("\nSummary:")
-    print(
-        "Unplugged from AC on {} with {}% battery".format(
-            start_timestamp.strftime("%Y-%m-%d %H:%M:%S"), start_charge
-        )
-    )
-    print(
-        "Used {:>3}% of battery during {:>3}h {:>2}min of active usage".format(
-            total_consumption_with_display_on,
-            int(total_time_with_display_on / 3600),
-            int(total_time_with_display_on % 3600 / 60),
-        )
-    )
-    print(
-        "Used {:>3}% of battery during {:>3}h {:>2}min of sleep".format(
-            total_consumption_with_display_off,
-            int(total_time_with_display_off / 3600),
-            int(total_time_with_display_off % 3600 / 60),
-        )
-    )
+    if max_charge_distance > 600:
+        print(f"Next best charge info was up to {max_charge_distance // 60} minutes off")
 
-    # output statistics
-    print("\nStatistics:")
+    # output summary and statistics with a single write
     rate_with_display_on = 0.0
     if total_time_with_display_on > 0:
         rate_with_display_on = total_consumption_with_display_on / (total_time_with_display_on / 3600)
-    print("{:.2f}%/h battery loss during usage".format(rate_with_display_on))
     rate_with_display_off = 0.0
     if total_time_with_display_off > 0:
         rate_with_display_off = total_consumption_with_display_off / (total_time_with_display_off / 3600)
-    print("{:.2f}%/h battery loss during sleep".format(rate_with_display_off))
+    output = [
+        "",
+        "Summary:",
+        f"Unplugged from AC on {format_timestamp(start_timestamp)} with {start_charge}% battery",
+        f"Used {total_consumption_with_display_on:>3}% of battery during "
+        f"{int(total_time_with_display_on / 3600):>3}h {int(total_time_with_display_on % 3600 / 60):>2}min "
+        f"of active usage",
+        f"Used {total_consumption_with_display_off:>3}% of battery during "
+        f"{int(total_time_with_display_off / 3600):>3}h {int(total_time_with_display_off % 3600 / 60):>2}min "
+        f"of sleep",
+        "",
+        "Statistics:",
+        f"{rate_with_display_on:.2f}%/h battery loss during usage",
+        f"{rate_with_display_off:.2f}%/h battery loss during sleep",
+    ]
+    sys.stdout.write("\n".join(output) + "\n")
 
 
 def main():
@@ -165,7 +181,7 @@ def main():
         sys.exit(2)
 
     if len(sys.argv) == 1:
-        pmset_lines = get_pmset_log().splitlines()
+        pmset_lines = list(get_pmset_log())
     else:
         # read log from a file
         with open(sys.argv[1], mode='r', encoding="utf-8") as f:
@@ -173,48 +189,191 @@ def main():
     process_lines(pmset_lines)
 
 
+def find_last_unplug(pmset_lines):
+    """
+    Find the index of a line from which on the log contains the last unplug event and the display state at that time.
+
+    The last unplug event is usually recent, so the log is scanned backwards from the end and the scan stops as soon
+    as both are found. If they can't be found, 0 is returned and the whole log is processed, which then reports the
+    error.
+    """
+    # bind the functions and markers used for every line to locals to avoid global lookups in the loops
+    parse = parse_line
+    display_marker = DISPLAY_MARKER
+    charge_marker = CHARGE_MARKER
+
+    # the unplug event is the first battery event following an AC event
+    unplug_index = None
+    for i in range(len(pmset_lines) - 1, -1, -1):
+        line = pmset_lines[i]
+        if charge_marker not in line:
+            continue
+        event = parse(line)
+        if event is None or event[2] is None:
+            continue
+        if event[2] != "AC":
+            unplug_index = i
+        elif unplug_index is not None:
+            ac_index = i
+            break
+    else:
+        return 0
+
+    # the display state at the unplug event is the one of the last display event up to the unplug event
+    for i in range(unplug_index, -1, -1):
+        line = pmset_lines[i]
+        if display_marker not in line:
+            continue
+        event = parse(line)
+        if event is not None and event[1] is not None:
+            # the AC event has to be processed as well to recognize the unplug event
+            return min(i, ac_index)
+    return 0
+
+
 def get_pmset_log():
-    raw_output = subprocess.check_output(["pmset", "-g", "log"])
-    return str(raw_output, "utf-8") if sys.version_info.major >= 3 else raw_output
+    """
+    Stream the log of pmset line by line.
+
+    Like ``subprocess.check_output`` this raises a ``CalledProcessError`` if pmset fails, once its output has been
+    consumed.
+    """
+    with subprocess.Popen(["pmset", "-g", "log"], stdout=subprocess.PIPE, encoding="utf-8") as pmset:
+        yield from pmset.stdout
+    if pmset.returncode:
+        raise subprocess.CalledProcessError(pmset.returncode, pmset.args)
+
+
+def parse_line(line):
+    """
+    Parse a line of the pmset log.
+
+    Returns ``(timestamp, display_state, charge_type, charge)`` for lines with a display or charge event and ``None``
+    for all other lines. A line can contain both events, the fields of a missing event are ``None``. The lines have a
+    rigid structure, so plain string operations are used instead of regular expressions.
+    """
+    # most lines are neither charge nor display events, so look for the markers before anything else, callers in hot
+    # loops may skip these lines before even calling the parser
+    display_pos = line.find(DISPLAY_MARKER)
+    charge_pos = line.rfind(CHARGE_MARKER)
+    if display_pos == -1 and charge_pos == -1:
+        return None
+
+    # skip lines without a timestamp, e.g. headers and summaries
+    if (
+        len(line) <= TIMESTAMP_LENGTH
+        or line[4] != "-"
+        or line[7] != "-"
+        or line[20] not in "+-"
+        or not line[0:4].isdecimal()
+        or not line[5:7].isdecimal()
+        or not line[8:10].isdecimal()
+        or not line[11:13].isdecimal()
+        or not line[14:16].isdecimal()
+        or not line[17:19].isdecimal()
+    ):
+        return None
+
+    display_state = None
+    if display_pos != -1:
+        # the display message directly follows the category of the message, e.g. "Notification"
+        message = line[TIMESTAMP_LENGTH:display_pos]
+        if len(message.split()) == 1 and message[0].isspace() and message[-1].isspace():
+            state = line[display_pos + len(DISPLAY_MARKER):].split(None, 1)
+            if state:
+                display_state = state[0]
+
+    # e.g. "Using Batt (Charge:42%)" or "Using AC(Charge:100)", the marker can also appear earlier in the message
+    # (e.g. "due to 'Using lid'"), so the occurrences are tried from the last one backwards
+    charge = None
+    while charge_pos >= TIMESTAMP_LENGTH:
+        charge = parse_charge(line[charge_pos + len(CHARGE_MARKER):])
+        if charge is not None:
+            break
+        charge_pos = line.rfind(CHARGE_MARKER, TIMESTAMP_LENGTH, charge_pos)
+
+    if charge is not None:
+        return (line[:19], display_state) + charge
+    if display_state is not None:
+        return line[:19], display_state, None, None
+    return None
+
+
+def parse_charge(text):
+    """
+    Parse the type and charge from the text following the "Using " marker, e.g. "Batt (Charge:42%) 2 secs".
+
+    Returns ``(type, charge)`` or ``None`` if the text does not describe a charge.
+    """
+    charge_type = text[:2] if text.startswith("AC") else text[:4]
+    if charge_type not in CHARGE_TYPES:
+        return None
+    text = text[len(charge_type):].lstrip()
+    if not text.startswith("(Charge:"):
+        return None
+    end = text.find(")")
+    if end == -1:
+        return None
+    # the percent sign is optional
+    charge = text[8:end].lstrip().rstrip("%")
+    if not charge.isdecimal():
+        return None
+    return charge_type, int(charge)
 
 
 def convert_timestamp(timestamp):
-    return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+    """
+    Convert a timestamp of the log to seconds since the epoch.
+
+    The timestamp has the fixed format "%Y-%m-%d %H:%M:%S", which is much faster to slice than to strptime. The
+    timezone offset is ignored, so the result is only meant for comparing timestamps of the log with each other and
+    for printing them with ``format_timestamp``.
+    """
+    return timegm((
+        int(timestamp[0:4]),
+        int(timestamp[5:7]),
+        int(timestamp[8:10]),
+        int(timestamp[11:13]),
+        int(timestamp[14:16]),
+        int(timestamp[17:19]),
+    ))
 
 
-def get_closest_event(events, timestamp):
+def format_timestamp(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp))
+
+
+def get_closest_charge(times, values, timestamp, lo=0):
     """
-    Get the event with the closest timestamp.
+    Get the charge of the event with the closest timestamp and its distance in seconds to the given timestamp, all
+    timestamps are in epoch seconds.
+
+    The bisect position is returned as well, so lookups of later timestamps can pass it as ``lo`` instead of
+    searching all events again.
+
+    Timestamps before the first or after the last charge event report the distance to that event too, so stale
+    charge info at the end of the log is not hidden.
     """
-    timestamps_of_events = [event[0] for event in events]
-    pos = bisect_left(timestamps_of_events, timestamp)
+    pos = bisect_left(times, timestamp, lo)
     if pos == 0:
-        return events[0]
-    elif pos == len(events):
-        return events[-1]
+        return values[0], times[0] - timestamp, pos
+    elif pos == len(times):
+        return values[-1], timestamp - times[-1], pos
     else:
-        before = events[pos - 1]
-        after = events[pos]
-        delta_to_before = (timestamp - before[0]).total_seconds()
-        delta_to_after = (after[0] - timestamp).total_seconds()
-        if min(delta_to_after, delta_to_before) > 600:
-            print(
-                "Next best charge info is {} minutes off".format(
-                    min(delta_to_after, delta_to_before) // 60
-                )
-            )
-        return before if delta_to_before < delta_to_after else after
+        delta_to_before = timestamp - times[pos - 1]
+        delta_to_after = times[pos] - timestamp
+        if delta_to_before < delta_to_after:
+            return values[pos - 1], delta_to_before, pos
+        return values[pos], delta_to_after, pos
 
 
 def get_current_charge():
-    for line in subprocess.check_output(
-        ["ioreg", "-rn", "AppleSmartBattery"]
-    ).splitlines():
-        if b"CurrentCapacity" in line:
-            return int(line.split()[-1])
-    else:
+    output = subprocess.check_output(["ioreg", "-rn", "AppleSmartBattery"])
+    match = re.search(rb'"CurrentCapacity"\s*=\s*(\d+)', output)
+    if not match:
         print("Could not read current battery capacity")
         sys.exit(1)
+    return int(match.group(1))
 
 
 if __name__ == "__main__":